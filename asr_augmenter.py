@@ -1,12 +1,69 @@
 import os
-import json
+import orjson
 import torch
 import random
+import numpy as np
 import nlpaug.augmenter.word as naw
 import nlpaug.augmenter.char as nac
 import re
+from functools import lru_cache
+from multiprocessing import Pool, cpu_count
+from tqdm import tqdm
 from typing import List, Dict
 
+# 使用的增强器：'char' 为字符级随机替换（多进程并行），'word' 为基于BERT的上下文词替换
+AUGMENTER = 'char'
+
+# BERT增强器配置：CUDA上使用半精度PyTorch推理；CPU上使用ONNX Runtime，模型首次使用时导出并缓存到本地目录
+BERT_MODEL_PATH = 'bert-base-uncased'
+USE_ONNX_RUNTIME = True
+ONNX_MODEL_DIR = 'bert-base-uncased-onnx'  # 导出的FP32模型，作为量化的输入
+ONNX_INT8_MODEL_DIR = 'bert-base-uncased-onnx-int8'  # CPU上使用的INT8动态量化模型
+ONNX_MODEL_FILE = 'model.onnx'
+ONNX_INT8_MODEL_FILE = 'model_quantized.onnx'
+
+# 同音字替换字典
+_HOMO = {
+    "there": ["their", "they're"],
+    "to": ["too", "two"],
+    "four": ["for", "fore"],
+    "write": ["right", "rite"],
+    "hear": ["here", "hair"],
+    "your": ["you're", "yore"],
+    "its": ["it's"],
+    "weather": ["whether"],
+    "which": ["witch"],
+    "who's": ["whose"],
+    "accept": ["except"],
+    "affect": ["effect"]
+}
+
+# 语音混淆字典
+_PHON = {
+    "s": ["z", "c"],
+    "f": ["th", "ph"],
+    "k": ["c", "q"],
+    "m": ["n"],
+    "d": ["t"],
+    "b": ["p"],
+    "v": ["f"],
+    "g": ["j"],
+    "ch": ["sh", "tch"],
+    "ai": ["ay", "ei"]
+}
+
+# 语音混淆模式在随机掩码中对应的列
+_PHON_INDEX = {sound: j for j, sound in enumerate(_PHON)}
+# 单字符模式通过 str.translate 在C层完成替换：(字符码, 掩码列, 候选替换)
+_PHON_SINGLE = [
+    (ord(sound), _PHON_INDEX[sound], alternatives)
+    for sound, alternatives in _PHON.items() if len(sound) == 1
+]
+# 多字符模式的预编译正则，长模式优先匹配
+_PHON_RE = re.compile('|'.join(map(re.escape, sorted(
+    (sound for sound in _PHON if len(sound) > 1), key=len, reverse=True))))
+
+@lru_cache(maxsize=4096)
 def get_file_number(filename):
     """
     从文件名中提取数字部分。例如，dialogues_001.json -> 1
@@ -25,80 +82,140 @@ def add_common_asr_errors(text: str) -> str:
     """
     模拟常见的ASR错误，包括同音字替换和语音混淆
     """
-    # 同音字替换字典
-    homophones = {
-        "there": ["their", "they're"],
-        "to": ["too", "two"],
-        "four": ["for", "fore"],
-        "write": ["right", "rite"],
-        "hear": ["here", "hair"],
-        "your": ["you're", "yore"],
-        "its": ["it's"],
-        "weather": ["whether"],
-        "which": ["witch"],
-        "who's": ["whose"],
-        "accept": ["except"],
-        "affect": ["effect"]
-    }
-    
-    # 语音混淆字典
-    phonetic_errors = {
-        "s": ["z", "c"],
-        "f": ["th", "ph"],
-        "k": ["c", "q"],
-        "m": ["n"],
-        "d": ["t"],
-        "b": ["p"],
-        "v": ["f"],
-        "g": ["j"],
-        "ch": ["sh", "tch"],
-        "ai": ["ay", "ei"]
-    }
-
     # 分词处理
     words = text.split()
-    modified_words = []
-
-    for word in words:
-        # 随机决定是否对当前词进行修改
-        if random.random() < 0.4:  # 30%的概率进行修改
-            # 检查同音字替换
-            lower_word = word.lower()
-            if lower_word in homophones:
-                word = random.choice(homophones[lower_word])
-            else:
-                # 应用语音混淆
-                for sound, alternatives in phonetic_errors.items():
-                    if sound in lower_word and random.random() < 0.4:  # 20%的概率进行音素替换
-                        word = word.replace(sound, random.choice(alternatives))
-        
-        modified_words.append(word)
+    n = len(words)
+    # 一次性生成所有随机决策：每个词40%的概率进行修改，每个音素40%的概率进行替换
+    word_mask = np.random.random(n) < 0.4
+    phon_mask = np.random.random((n, len(_PHON))) < 0.4
+    modified_words = list(words)
+
+    # 只遍历被选中修改的词
+    for i in np.flatnonzero(word_mask):
+        word = words[i]
+        # 检查同音字替换
+        lower_word = word.lower()
+        if lower_word in _HOMO:
+            modified_words[i] = random.choice(_HOMO[lower_word])
+        else:
+            row = phon_mask[i]
+            # 单字符语音混淆：按掩码构造转换表
+            table = {code: random.choice(alternatives)
+                     for code, j, alternatives in _PHON_SINGLE if row[j]}
+            # 多字符模式在原词上匹配，避免单字符替换后新产生的组合（如 k->c 后的 "ch"）被再次替换；
+            # 匹配之间的片段用 translate 完成单字符替换
+            pieces = []
+            pos = 0
+            for m in _PHON_RE.finditer(word):
+                pieces.append(word[pos:m.start()].translate(table))
+                sound = m.group(0)
+                pieces.append(random.choice(_PHON[sound]) if row[_PHON_INDEX[sound]] else sound)
+                pos = m.end()
+            pieces.append(word[pos:].translate(table))
+            modified_words[i] = "".join(pieces)
 
     return " ".join(modified_words)
 
-def simulate_asr_errors(text: str, augmenter, aug_p=0.3) -> str:
+def simulate_asr_errors(texts: List[str], augmenter, aug_p=0.3) -> List[str]:
     """
-    组合多种ASR错误模拟方法
+    组合多种ASR错误模拟方法，对一批文本整体调用增强器
     """
-    # 首先应用nlpaug增强
-    augmented_text = augmenter.augment(text)[0]
+    # 首先应用nlpaug增强，列表输入会在增强器内部按批次处理
+    augmented_texts = augmenter.augment(texts)
     
     # 然后应用常见ASR错误模拟
-    final_text = add_common_asr_errors(augmented_text)
+    final_texts = [add_common_asr_errors(text) for text in augmented_texts]
+    
+    return final_texts
+
+def create_char_augmenter():
+    """
+    创建字符级别的增强器
+    """
+    # RandomCharAug的正确参数设置
+    return nac.RandomCharAug(
+        action="substitute",
+        aug_char_p=0.2,  # 替换为aug_char_p
+        aug_word_p=0.3   # 添加aug_word_p参数
+    )
+
+def enable_half_precision(word_aug):
+    """
+    将ContextualWordEmbsAug内部的BERT模型转换为半精度（支持时使用BF16），
+    并让前向计算在inference_mode和autocast下运行。仅用于CUDA设备。
+    """
+    dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    model = word_aug.model.model
+    model.to(dtype)
+    model.eval()
+    
+    forward = model.forward
+    
+    def half_precision_forward(*args, **kwargs):
+        with torch.inference_mode(), torch.autocast(device_type='cuda', dtype=dtype):
+            return forward(*args, **kwargs)
+    
+    model.forward = half_precision_forward
+
+def enable_onnx_runtime(word_aug):
+    """
+    将ContextualWordEmbsAug内部的BERT模型替换为INT8动态量化的ONNX Runtime模型（CPU），分词器保持不变。
+    optimum 在此处导入，未安装时由调用方回退到PyTorch推理，不影响字符级增强。
+    """
+    from optimum.onnxruntime import ORTModelForMaskedLM, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
     
-    return final_text
+    # 以模型文件而非目录判断导出是否完成，避免使用中途失败留下的不完整目录
+    if not os.path.isfile(os.path.join(ONNX_MODEL_DIR, ONNX_MODEL_FILE)):
+        ort_model = ORTModelForMaskedLM.from_pretrained(BERT_MODEL_PATH, export=True)
+        ort_model.save_pretrained(ONNX_MODEL_DIR)
+    
+    if not os.path.isfile(os.path.join(ONNX_INT8_MODEL_DIR, ONNX_INT8_MODEL_FILE)):
+        quantizer = ORTQuantizer.from_pretrained(ONNX_MODEL_DIR)
+        qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        quantizer.quantize(save_dir=ONNX_INT8_MODEL_DIR, quantization_config=qconfig)
+    ort_model = ORTModelForMaskedLM.from_pretrained(
+        ONNX_INT8_MODEL_DIR, file_name=ONNX_INT8_MODEL_FILE, provider='CPUExecutionProvider'
+    )
+    
+    word_aug.model.model = ort_model
+
+def accelerate_word_augmenter(word_aug, device):
+    """
+    为BERT增强器选择推理后端：CUDA上保持PyTorch并使用半精度；
+    CPU上优先使用INT8量化的ONNX Runtime模型，失败时回退到PyTorch。
+    只应在该增强器实际被使用时调用，避免无谓的模型导出和量化。
+    """
+    if device == 'cuda':
+        enable_half_precision(word_aug)
+        return
+    if USE_ONNX_RUNTIME:
+        try:
+            enable_onnx_runtime(word_aug)
+        except Exception as e:
+            # 回退到PyTorch推理
+            print(f"Could not switch ContextualWordEmbsAug to ONNX Runtime: {e}")
 
 def process_file(input_path: str, output_path: str, augmenter):
     """
     处理单个JSON文件，修改其中的utterance字段，并保存到输出路径。
     """
-    with open(input_path, 'r', encoding='utf-8') as infile:
+    with open(input_path, 'rb') as infile:
         try:
-            data = json.load(infile)
-        except json.JSONDecodeError as e:
+            data = orjson.loads(infile.read())
+        except orjson.JSONDecodeError as e:
             print(f"Error decoding JSON from {input_path}: {e}")
             return
     
+    # 收集需要增强的轮次，整个文件一次性批量增强
+    turns_to_augment = []
+    
+    # 文件名中的数字对整个文件只需解析一次
+    filename = os.path.basename(input_path)
+    file_number = get_file_number(filename)
+    if file_number is None:
+        print(f"Could not extract file number from filename: {filename}")
+    
     # 遍历每个对话
     for dialogue in data:
         dialogue_id = dialogue.get("dialogue_id", "")
@@ -114,25 +231,48 @@ def process_file(input_path: str, output_path: str, augmenter):
             continue
         
         # 检查文件名中的数字
-        filename = os.path.basename(input_path)
-        file_number = get_file_number(filename)
         if file_number is None:
-            print(f"Could not extract file number from filename: {filename}")
             continue
         
         if dialogue_number != file_number:
             print(f"Dialogue ID {dialogue_id} does not match file number {file_number} in {filename}")
         
-        # 处理每个轮次的utterance
+        # 收集每个轮次的utterance
         for turn in dialogue.get("turns", []):
             utterance = turn.get("utterance", "")
             if utterance:
-                augmented_utterance = simulate_asr_errors(utterance, augmenter)
-                turn["utterance"] = augmented_utterance
+                turns_to_augment.append(turn)
+    
+    # 批量增强后按顺序写回
+    if turns_to_augment:
+        utterances = [turn["utterance"] for turn in turns_to_augment]
+        augmented_utterances = simulate_asr_errors(utterances, augmenter)
+        for turn, augmented_utterance in zip(turns_to_augment, augmented_utterances):
+            turn["utterance"] = augmented_utterance
     
     # 保存修改后的数据
-    with open(output_path, 'w', encoding='utf-8') as outfile:
-        json.dump(data, outfile, ensure_ascii=False, indent=2)
+    with open(output_path, 'wb') as outfile:
+        outfile.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+
+# 工作进程中的字符级增强器，在进程内重新创建以避免pickle
+_worker_augmenter = None
+
+def _init_worker():
+    """
+    初始化工作进程：重新设置随机种子，避免fork出的进程产生相同的随机序列
+    """
+    global _worker_augmenter
+    random.seed()
+    np.random.seed()
+    _worker_augmenter = create_char_augmenter()
+
+def _work(paths):
+    """
+    在工作进程中处理单个JSON文件
+    """
+    input_path, output_path = paths
+    process_file(input_path, output_path, _worker_augmenter)
+    return os.path.basename(input_path)
 
 def main():
     input_folder = 'test'
@@ -145,40 +285,41 @@ def main():
     else:
         device = 'cpu'
     
-    # 创建多个增强器
-    augmenters = []
-    
-    # 添加字符级别的增强器
-    # RandomCharAug的正确参数设置
-    char_aug = nac.RandomCharAug(
-        action="substitute",
-        aug_char_p=0.2,  # 替换为aug_char_p
-        aug_word_p=0.3   # 添加aug_word_p参数
-    )
-    augmenters.append(char_aug)
+    # 只有选择了BERT增强器时才加载模型，否则使用字符级增强器（在工作进程中创建）
+    word_aug = None
+    if AUGMENTER == 'word':
+        try:
+            word_aug = naw.ContextualWordEmbsAug(
+                model_path=BERT_MODEL_PATH,
+                action="substitute",
+                device=device,
+                aug_p=0.2,
+                batch_size=64  # 批量前向计算的句子数
+            )
+            accelerate_word_augmenter(word_aug, device)
+        except Exception as e:
+            print(f"Could not initialize ContextualWordEmbsAug, using the character augmenter: {e}")
+            word_aug = None
     
-    # 尝试添加上下文词嵌入增强器
-    try:
-        word_aug = naw.ContextualWordEmbsAug(
-            model_path='bert-base-uncased',
-            action="substitute",
-            device=device,
-            aug_p=0.2
-        )
-        augmenters.append(word_aug)
-    except Exception as e:
-        print(f"Could not initialize ContextualWordEmbsAug: {e}")
-    
-    # 选择主要增强器
-    primary_augmenter = augmenters[0] if augmenters else char_aug
+    json_files = [
+        (os.path.join(input_folder, filename), os.path.join(output_folder, filename))
+        for filename in os.listdir(input_folder)
+        if filename.endswith('.json')
+    ]
     
     # 处理所有文件
-    for filename in os.listdir(input_folder):
-        if filename.endswith('.json'):
-            input_path = os.path.join(input_folder, filename)
-            output_path = os.path.join(output_folder, filename)
-            print(f"Processing {filename}...")
-            process_file(input_path, output_path, primary_augmenter)
+    if word_aug is None:
+        # 字符级增强器只使用CPU，没有共享的GPU状态，按文件多进程并行
+        num_workers = max(cpu_count() - 1, 1)
+        with Pool(processes=num_workers, initializer=_init_worker) as pool:
+            for _ in tqdm(pool.imap_unordered(_work, json_files), total=len(json_files),
+                          desc="Processing files", unit="file"):
+                pass
+    else:
+        # BERT增强器持有单个模型，在主进程中串行处理
+        for input_path, output_path in json_files:
+            print(f"Processing {os.path.basename(input_path)}...")
+            process_file(input_path, output_path, word_aug)
     
     print("ASR增强完成。增强后的文件保存在 'dev_augmented' 文件夹中。")
 
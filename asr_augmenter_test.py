@@ -0,0 +1,111 @@
+# coding=utf-8
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for asr_augmenter.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import random
+
+from absl.testing import absltest
+import numpy as np
+
+from schema_guided_dst import asr_augmenter
+
+_TEXT = 'there is a big dog which shall chase the ship in the rain'
+
+
+def _seed(seed):
+  random.seed(seed)
+  np.random.seed(seed)
+
+
+class AddCommonAsrErrorsTest(absltest.TestCase):
+  """Tests for add_common_asr_errors."""
+
+  def test_deterministic_with_seed(self):
+    _seed(0)
+    first = [asr_augmenter.add_common_asr_errors(_TEXT) for _ in range(5)]
+    _seed(0)
+    second = [asr_augmenter.add_common_asr_errors(_TEXT) for _ in range(5)]
+    self.assertEqual(first, second)
+
+  def test_modifies_some_outputs(self):
+    _seed(0)
+    outputs = [asr_augmenter.add_common_asr_errors(_TEXT) for _ in range(20)]
+    self.assertTrue(any(output != _TEXT for output in outputs))
+
+  def test_preserves_word_count(self):
+    _seed(1)
+    for _ in range(50):
+      output = asr_augmenter.add_common_asr_errors(_TEXT)
+      self.assertLen(output.split(), len(_TEXT.split()))
+
+  def test_homophone_substitution(self):
+    _seed(2)
+    for _ in range(50):
+      output = asr_augmenter.add_common_asr_errors('there')
+      self.assertIn(output, ['there', 'their', "they're"])
+
+  def test_multi_char_patterns_match_original_word(self):
+    # A k->c substitution must not create a new 'ch' that is replaced again.
+    _seed(3)
+    for _ in range(500):
+      output = asr_augmenter.add_common_asr_errors('kh ship')
+      self.assertNotIn(output.split()[0], ['sh', 'tch'])
+      self.assertNotIn('hh', output)
+
+  def test_empty_text(self):
+    self.assertEqual(asr_augmenter.add_common_asr_errors(''), '')
+
+
+class AccelerateWordAugmenterTest(absltest.TestCase):
+  """Tests for the inference backend chosen for the BERT augmenter."""
+
+  def setUp(self):
+    super(AccelerateWordAugmenterTest, self).setUp()
+    self.calls = []
+    self._orig = (asr_augmenter.enable_half_precision,
+                  asr_augmenter.enable_onnx_runtime)
+    asr_augmenter.enable_half_precision = (
+        lambda word_aug: self.calls.append('half'))
+    asr_augmenter.enable_onnx_runtime = (
+        lambda word_aug: self.calls.append('onnx'))
+
+  def tearDown(self):
+    (asr_augmenter.enable_half_precision,
+     asr_augmenter.enable_onnx_runtime) = self._orig
+    super(AccelerateWordAugmenterTest, self).tearDown()
+
+  def test_cuda_keeps_half_precision_torch(self):
+    asr_augmenter.accelerate_word_augmenter(object(), 'cuda')
+    self.assertEqual(self.calls, ['half'])
+
+  def test_cpu_uses_onnx_runtime(self):
+    asr_augmenter.accelerate_word_augmenter(object(), 'cpu')
+    self.assertEqual(self.calls, ['onnx'])
+
+  def test_cpu_falls_back_to_torch(self):
+    def fail(word_aug):
+      raise ImportError('optimum')
+    asr_augmenter.enable_onnx_runtime = fail
+    asr_augmenter.accelerate_word_augmenter(object(), 'cpu')
+    self.assertEqual(self.calls, [])
+
+
+if __name__ == "__main__":
+  absltest.main()
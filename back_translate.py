@@ -1,57 +1,339 @@
 import os
-import json
-from googletrans import Translator
+import orjson
 from tqdm import tqdm
-import copy
 import time
+import hashlib
+import sqlite3
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def back_translate(text, translator, src_lang='en', intermediate_lang='zh-cn'):
+# 翻译后端：'marian' 使用本地 MarianMT 模型，'google' 使用 googletrans 在线接口
+TRANSLATOR_BACKEND = 'marian'
+
+# 本地 MarianMT 模型配置
+MARIAN_MODELS = {
+    ('en', 'zh-cn'): 'Helsinki-NLP/opus-mt-en-zh',
+    ('zh-cn', 'en'): 'Helsinki-NLP/opus-mt-zh-en',
+}
+MARIAN_BATCH_SIZE = 64  # 每次前向计算的句子数，本地后端没有URL长度限制
+MARIAN_MAX_LENGTH = 256
+
+# 翻译缓存配置
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'bt_cache.sqlite')
+CACHE_COMMIT_INTERVAL = 50  # 每插入多少条记录提交一次
+
+# 并发与限流配置
+MAX_WORKERS = 8
+REQUEST_TIMEOUT = 10.0  # googletrans 单次请求超时（秒）
+RATE_LIMIT = 20 / 60  # 每秒允许的请求数（约20次/分钟），googletrans 对列表中的每条文本单独发请求
+RATE_BURST = 4
+
+# 批量翻译配置
+BATCH_SIZE = 50  # 每次调用 translate 最多包含的文本数
+BATCH_MAX_CHARS = 5000  # 每次调用的最大字符数，避免URL过长
+
+
+class RateLimiter:
+    """
+    基于单调时钟的令牌桶限流器，只有在没有可用令牌时才休眠。
+    """
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n=1):
+        """
+        获取 n 个令牌，每个令牌对应一次网络请求；逐个获取，因此 n 可以大于 burst。
+        """
+        for _ in range(n):
+            self._acquire_one()
+
+    def _acquire_one(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class TranslationCache:
+    """
+    基于sqlite的持久化翻译缓存，键为 md5(backend|text|src|dest)，跨文件、跨运行复用翻译结果，
+    不同翻译后端的结果互不混用。
+    """
+
+    def __init__(self, path=CACHE_PATH, commit_interval=CACHE_COMMIT_INTERVAL,
+                 backend=TRANSLATOR_BACKEND):
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        # 工作线程共享同一连接，读写由 self.lock 串行化
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, value TEXT)'
+        )
+        self.conn.commit()
+        self.commit_interval = commit_interval
+        self.backend = backend
+        self.pending = 0
+
+    def make_key(self, text, src, dest):
+        return hashlib.md5(f"{self.backend}|{text}|{src}|{dest}".encode('utf-8')).hexdigest()
+
+    def get(self, text, src, dest):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value FROM translations WHERE key = ?',
+                (self.make_key(text, src, dest),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, text, src, dest, value):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO translations (key, value) VALUES (?, ?)',
+                (self.make_key(text, src, dest), value)
+            )
+            self.pending += 1
+            if self.pending >= self.commit_interval:
+                self.conn.commit()
+                self.pending = 0
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+def create_translator():
+    """
+    创建 googletrans 翻译器，底层 httpx 客户端启用HTTP/2长连接，
+    后续请求复用已建立的连接，避免每次重新进行TCP/TLS握手。
+    仅在使用 google 后端时才需要安装 googletrans 和 httpx。
+    """
+    import httpx
+    from googletrans import Translator
+    return Translator(http2=True, timeout=httpx.Timeout(REQUEST_TIMEOUT))
+
+# 每个工作线程各自持有的 googletrans 翻译器
+_tls = threading.local()
+# 所有线程创建过的翻译器，线程池关闭后由 close_translators 统一关闭
+_translators = []
+_translators_lock = threading.Lock()
+
+def get_translator():
+    """
+    返回当前线程的翻译器，首次调用时创建，避免多个线程争用同一个 httpx 客户端。
+    线程池在所有文件间共享，因此每个线程的长连接在整个运行期间复用。
     """
-    将文本翻译到中间语言，再翻译回原始语言，实现回译。
+    translator = getattr(_tls, 'translator', None)
+    if translator is None:
+        translator = create_translator()
+        _tls.translator = translator
+        with _translators_lock:
+            _translators.append(translator)
+    return translator
+
+def close_translators():
+    """
+    关闭 get_translator 创建的所有翻译器的 httpx 客户端，应在线程池关闭后调用。
+    """
+    with _translators_lock:
+        translators = list(_translators)
+        del _translators[:]
+    for translator in translators:
+        client = getattr(translator, 'client', None)
+        if client is not None:
+            client.close()
+
+
+Translated = namedtuple('Translated', ['text'])
+
+
+class MarianTranslator:
+    """
+    基于本地 MarianMT 模型的翻译器，接口与 googletrans.Translator.translate 保持一致。
+    GPU可用时以FP16运行，按批次分词并调用 generate，不需要网络请求和限流。
+    仅在使用 marian 后端时才需要安装 torch 和 transformers。
+    """
+
+    def __init__(self, models=MARIAN_MODELS, batch_size=MARIAN_BATCH_SIZE,
+                 max_length=MARIAN_MAX_LENGTH):
+        import torch
+        from transformers import MarianMTModel, MarianTokenizer
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.models = {}
+        for pair, model_name in models.items():
+            tokenizer = MarianTokenizer.from_pretrained(model_name)
+            model = MarianMTModel.from_pretrained(model_name)
+            if self.device == 'cuda':
+                model = model.half()
+            model.to(self.device).eval()
+            self.models[pair] = (tokenizer, model)
+
+    def translate(self, text, src='en', dest='zh-cn'):
+        import torch
+        if (src, dest) not in self.models:
+            raise ValueError(f"No MarianMT model configured for {src} -> {dest}")
+        tokenizer, model = self.models[(src, dest)]
+        texts = [text] if isinstance(text, str) else list(text)
+
+        outputs = []
+        for i in range(0, len(texts), self.batch_size):
+            batch = texts[i:i + self.batch_size]
+            inputs = tokenizer(batch, return_tensors='pt', padding=True,
+                               truncation=True, max_length=self.max_length).to(self.device)
+            with torch.inference_mode():
+                generated = model.generate(**inputs, max_length=self.max_length, num_beams=1)
+            outputs.extend(tokenizer.batch_decode(generated, skip_special_tokens=True))
+
+        results = [Translated(output) for output in outputs]
+        return results[0] if isinstance(text, str) else results
+
+
+def make_batches(texts, max_size=BATCH_SIZE, max_chars=BATCH_MAX_CHARS):
+    """
+    将文本列表切分为批次，每批不超过 max_size 条且总字符数不超过 max_chars，避免URL过长。
+    max_chars 为 None 时不限制字符数。
+    """
+    batches = []
+    batch, batch_chars = [], 0
+    for text in texts:
+        too_long = max_chars is not None and batch_chars + len(text) > max_chars
+        if batch and (len(batch) >= max_size or too_long):
+            batches.append(batch)
+            batch, batch_chars = [], 0
+        batch.append(text)
+        batch_chars += len(text)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def translate_batch(texts, translator, src, dest, cache=None, limiter=None,
+                    batch_size=BATCH_SIZE, max_chars=BATCH_MAX_CHARS):
+    """
+    带缓存的批量翻译，未命中缓存的文本合并为一次 translate 调用，返回与输入对齐的译文列表（失败为None）。
+    googletrans 对列表中的每条文本单独发送请求，因此按文本数量获取令牌。
+    """
+    results = [None] * len(texts)
+    missing = {}
+    for i, text in enumerate(texts):
+        cached = cache.get(text, src, dest) if cache is not None else None
+        if cached is not None:
+            results[i] = cached
+        else:
+            missing.setdefault(text, []).append(i)
+
+    for batch in make_batches(list(missing), batch_size, max_chars):
+        if limiter is not None:
+            limiter.acquire(len(batch))  # 限流，每条文本一个令牌
+        translated = translator.translate(batch, src=src, dest=dest)
+        for text, item in zip(batch, translated or []):
+            if not item or not item.text:
+                continue
+            if cache is not None:
+                cache.put(text, src, dest, item.text)
+            for i in missing[text]:
+                results[i] = item.text
+    return results
+
+def back_translate(texts, translator, src_lang='en', intermediate_lang='zh-cn', cache=None, limiter=None,
+                   batch_size=BATCH_SIZE, max_chars=BATCH_MAX_CHARS):
+    """
+    将一批文本翻译到中间语言，再翻译回原始语言，实现回译。翻译失败的文本保留原文。
+    translator 为 None 时使用当前线程的 googletrans 翻译器。
     """
     try:
-        if not isinstance(text, str) or not text.strip():
-            return text
+        if translator is None:
+            translator = get_translator()
+        results = list(texts)
+        valid = [i for i, text in enumerate(texts) if isinstance(text, str) and text.strip()]
+        if not valid:
+            return results
             
-        time.sleep(1)  # 添加延时避免请求过快
         # 翻译到中间语言
-        translated = translator.translate(text, src=src_lang, dest=intermediate_lang)
-        if not translated or not translated.text:
-            return text
+        translated = translate_batch([texts[i] for i in valid], translator,
+                                     src_lang, intermediate_lang, cache, limiter,
+                                     batch_size, max_chars)
+        valid = [(i, text) for i, text in zip(valid, translated) if text]
+        if not valid:
+            return results
             
-        time.sleep(1)  # 添加延时避免请求过快
         # 再翻译回原始语言
-        back_translated = translator.translate(translated.text, src=intermediate_lang, dest=src_lang)
-        return back_translated.text if back_translated else text
+        back_translated = translate_batch([text for _, text in valid], translator,
+                                          intermediate_lang, src_lang, cache, limiter,
+                                          batch_size, max_chars)
+        for (i, _), text in zip(valid, back_translated):
+            if text:
+                results[i] = text
+        return results
     except Exception as e:
         print(f"翻译出错: {e}")
-        return text
+        return list(texts)
 
-def process_file(input_filepath, output_filepath, translator):
+def process_file(input_filepath, output_filepath, translator, executor, cache=None, limiter=None,
+                 batch_size=BATCH_SIZE, max_chars=BATCH_MAX_CHARS):
     """
-    处理单个JSON文件，进行回译并添加噪声。
+    处理单个JSON文件，使用传入的线程池并发回译并添加噪声。
+    线程池由调用方在所有文件间共享，工作线程及其翻译器会话不会随文件结束而销毁。
     """
     try:
-        with open(input_filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        new_data = copy.deepcopy(data)
+        with open(input_filepath, 'rb') as f:
+            data = orjson.loads(f.read())
         
-        for dialogue in tqdm(new_data, desc=f"Processing {os.path.basename(input_filepath)}"):
+        # 文件内相同的utterance只回译一次，记录其所在的 (dialogue_idx, turn_idx)
+        positions = {}
+        for dialogue_idx, dialogue in enumerate(data):
             if 'turns' not in dialogue:
                 continue
                 
-            for turn in dialogue['turns']:
+            for turn_idx, turn in enumerate(dialogue['turns']):
                 if 'utterance' not in turn:
                     continue
                     
                 utterance = turn.get('utterance', '')
                 if utterance and isinstance(utterance, str):
-                    noisy_utterance = back_translate(utterance, translator)
-                    turn['utterance_noisy'] = noisy_utterance
+                    positions.setdefault(utterance, []).append((dialogue_idx, turn_idx))
 
-        with open(output_filepath, 'w', encoding='utf-8') as f:
-            json.dump(new_data, f, ensure_ascii=False, indent=2)
+        # 每个批次作为一个任务提交，每个方向一次 translate 调用
+        futures = {
+            executor.submit(back_translate, batch, translator,
+                            cache=cache, limiter=limiter,
+                            batch_size=batch_size, max_chars=max_chars): batch
+            for batch in make_batches(list(positions), batch_size, max_chars)
+        }
+        for future in tqdm(as_completed(futures), total=len(futures),
+                           desc=f"Processing {os.path.basename(input_filepath)}"):
+            batch = futures[future]
+            try:
+                noisy_utterances = future.result()
+            except Exception as e:
+                # 单个批次失败（如429）不影响整个文件，保留原文
+                print(f"回译出错: {e}")
+                noisy_utterances = batch
+            for utterance, noisy_utterance in zip(batch, noisy_utterances):
+                for dialogue_idx, turn_idx in positions[utterance]:
+                    data[dialogue_idx]['turns'][turn_idx]['utterance_noisy'] = noisy_utterance
+
+        with open(output_filepath, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
             
     except Exception as e:
         print(f"处理文件 {input_filepath} 时出错: {e}")
@@ -64,8 +346,21 @@ def main():
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
     
-    # 使用最新版本的 googletrans
-    translator = Translator()
+    if TRANSLATOR_BACKEND == 'marian':
+        # 本地模型无需限流；单个GPU模型串行执行批次即可，批次大小按模型设置
+        translator = MarianTranslator()
+        limiter = None
+        max_workers = 1
+        batch_size = MARIAN_BATCH_SIZE
+        max_chars = None
+    else:
+        # 使用最新版本的 googletrans，每个工作线程通过 get_translator 使用各自的会话
+        translator = None
+        limiter = RateLimiter()
+        max_workers = MAX_WORKERS
+        batch_size = BATCH_SIZE
+        max_chars = BATCH_MAX_CHARS
+    cache = TranslationCache(backend=TRANSLATOR_BACKEND)
     
     # 获取所有 JSON 文件并排序
     files = [f for f in os.listdir(input_folder) if f.endswith('.json')]
@@ -73,15 +368,25 @@ def main():
     
     print("将按顺序处理以下文件：", files)
     
-    for filename in files:
-        try:
-            input_filepath = os.path.join(input_folder, filename)
-            output_filepath = os.path.join(output_folder, filename)
-            print(f"正在处理文件: {filename}")
-            process_file(input_filepath, output_filepath, translator)
-        except Exception as e:
-            print(f"处理 {filename} 时出错: {e}")
-            continue
+    # 线程池在所有文件间共享，每个工作线程的翻译器会话在整个运行期间保持连接
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for filename in files:
+            try:
+                input_filepath = os.path.join(input_folder, filename)
+                output_filepath = os.path.join(output_folder, filename)
+                print(f"正在处理文件: {filename}")
+                process_file(input_filepath, output_filepath, translator, executor,
+                             cache, limiter, batch_size, max_chars)
+            except Exception as e:
+                print(f"处理 {filename} 时出错: {e}")
+                continue
+            finally:
+                cache.commit()
+    finally:
+        executor.shutdown(wait=True)
+        close_translators()
+        cache.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,267 @@
+# coding=utf-8
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for back_translate.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+
+from absl.testing import absltest
+
+from schema_guided_dst import back_translate
+
+
+class _StubTranslator(object):
+  """Translator stub that tags each text with its destination language."""
+
+  def __init__(self, fail=()):
+    self.calls = []
+    self._fail = set(fail)
+
+  def translate(self, texts, src, dest):
+    self.calls.append(list(texts))
+    return [
+        back_translate.Translated('' if text in self._fail else dest + ':' +
+                                  text) for text in texts
+    ]
+
+
+class _StubClient(object):
+  """HTTP client stub that records whether it was closed."""
+
+  def __init__(self):
+    self.closed = False
+
+  def close(self):
+    self.closed = True
+
+
+class _FakeClock(object):
+  """Monotonic clock whose sleep() advances time instantly."""
+
+  def __init__(self):
+    self.now = 0.0
+    self.slept = 0.0
+
+  def monotonic(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.now += seconds
+    self.slept += seconds
+
+
+class TranslationCacheTest(absltest.TestCase):
+  """Tests for TranslationCache."""
+
+  def setUp(self):
+    super(TranslationCacheTest, self).setUp()
+    self._path = os.path.join(absltest.get_default_test_tmpdir(),
+                              self._testMethodName + '.sqlite')
+    if os.path.exists(self._path):
+      os.remove(self._path)
+
+  def test_get_and_put(self):
+    cache = back_translate.TranslationCache(self._path, backend='google')
+    self.assertIsNone(cache.get('hello', 'en', 'zh-cn'))
+    cache.put('hello', 'en', 'zh-cn', '你好')
+    self.assertEqual(cache.get('hello', 'en', 'zh-cn'), '你好')
+    # The key includes the translation direction.
+    self.assertIsNone(cache.get('hello', 'zh-cn', 'en'))
+    cache.close()
+
+  def test_backend_is_part_of_key(self):
+    cache = back_translate.TranslationCache(self._path, backend='google')
+    cache.put('hello', 'en', 'zh-cn', '你好')
+    cache.close()
+    cache = back_translate.TranslationCache(self._path, backend='marian')
+    self.assertIsNone(cache.get('hello', 'en', 'zh-cn'))
+    cache.close()
+
+  def test_commits_in_batches(self):
+    cache = back_translate.TranslationCache(self._path, commit_interval=3)
+    cache.put('a', 'en', 'zh-cn', 'A')
+    cache.put('b', 'en', 'zh-cn', 'B')
+    self.assertEqual(cache.pending, 2)
+    cache.put('c', 'en', 'zh-cn', 'C')
+    self.assertEqual(cache.pending, 0)
+    cache.put('d', 'en', 'zh-cn', 'D')
+
+    # Only the committed rows are visible from another connection.
+    other = back_translate.TranslationCache(self._path)
+    self.assertEqual(other.get('c', 'en', 'zh-cn'), 'C')
+    self.assertIsNone(other.get('d', 'en', 'zh-cn'))
+    cache.close()
+    self.assertEqual(other.get('d', 'en', 'zh-cn'), 'D')
+    other.close()
+
+
+class RateLimiterTest(absltest.TestCase):
+  """Tests for RateLimiter."""
+
+  def setUp(self):
+    super(RateLimiterTest, self).setUp()
+    self._clock = _FakeClock()
+    self._orig_time = back_translate.time
+    back_translate.time = self._clock
+
+  def tearDown(self):
+    back_translate.time = self._orig_time
+    super(RateLimiterTest, self).tearDown()
+
+  def test_burst_does_not_sleep(self):
+    limiter = back_translate.RateLimiter(rate=1.0, burst=4)
+    limiter.acquire(4)
+    self.assertEqual(self._clock.slept, 0.0)
+
+  def test_charges_one_token_per_request(self):
+    limiter = back_translate.RateLimiter(rate=2.0, burst=4)
+    # 10 tokens: 4 from the burst, the remaining 6 at 2 tokens per second.
+    limiter.acquire(10)
+    self.assertAlmostEqual(self._clock.slept, 3.0)
+    self.assertLess(limiter.tokens, 1)
+
+
+class MakeBatchesTest(absltest.TestCase):
+  """Tests for make_batches."""
+
+  def test_max_size(self):
+    batches = back_translate.make_batches(['x'] * 120, max_size=50)
+    self.assertEqual([len(batch) for batch in batches], [50, 50, 20])
+
+  def test_max_chars(self):
+    batches = back_translate.make_batches(['a' * 40] * 5, max_size=50,
+                                          max_chars=100)
+    self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+
+  def test_oversized_text_gets_own_batch(self):
+    batches = back_translate.make_batches(['a' * 200, 'b'], max_chars=100)
+    self.assertEqual(batches, [['a' * 200], ['b']])
+
+  def test_no_char_limit(self):
+    batches = back_translate.make_batches(['a' * 200] * 130, max_size=64,
+                                          max_chars=None)
+    self.assertEqual([len(batch) for batch in batches], [64, 64, 2])
+
+  def test_empty(self):
+    self.assertEqual(back_translate.make_batches([]), [])
+
+
+class TranslateBatchTest(absltest.TestCase):
+  """Tests for translate_batch and back_translate."""
+
+  def setUp(self):
+    super(TranslateBatchTest, self).setUp()
+    path = os.path.join(absltest.get_default_test_tmpdir(),
+                        self._testMethodName + '.sqlite')
+    if os.path.exists(path):
+      os.remove(path)
+    self._cache = back_translate.TranslationCache(path)
+
+  def tearDown(self):
+    self._cache.close()
+    super(TranslateBatchTest, self).tearDown()
+
+  def test_deduplicates_texts(self):
+    translator = _StubTranslator()
+    results = back_translate.translate_batch(['hi', 'bye', 'hi'], translator,
+                                             'en', 'zh-cn')
+    self.assertEqual(results, ['zh-cn:hi', 'zh-cn:bye', 'zh-cn:hi'])
+    self.assertEqual(translator.calls, [['hi', 'bye']])
+
+  def test_partial_failure(self):
+    translator = _StubTranslator(fail=['bye'])
+    results = back_translate.translate_batch(['hi', 'bye'], translator, 'en',
+                                             'zh-cn', cache=self._cache)
+    self.assertEqual(results, ['zh-cn:hi', None])
+    # Failed translations are not cached.
+    self.assertIsNone(self._cache.get('bye', 'en', 'zh-cn'))
+
+  def test_cache_short_circuit(self):
+    self._cache.put('hi', 'en', 'zh-cn', 'cached')
+    translator = _StubTranslator()
+    results = back_translate.translate_batch(['hi', 'bye'], translator, 'en',
+                                             'zh-cn', cache=self._cache)
+    self.assertEqual(results, ['cached', 'zh-cn:bye'])
+    self.assertEqual(translator.calls, [['bye']])
+
+    translator = _StubTranslator()
+    results = back_translate.translate_batch(['hi', 'bye'], translator, 'en',
+                                             'zh-cn', cache=self._cache)
+    self.assertEqual(results, ['cached', 'zh-cn:bye'])
+    self.assertEqual(translator.calls, [])
+
+  def test_back_translate_keeps_original_on_failure(self):
+    translator = _StubTranslator(fail=['zh-cn:bye'])
+    results = back_translate.back_translate(['hi', 'bye', '  '], translator,
+                                            cache=self._cache)
+    self.assertEqual(results, ['en:zh-cn:hi', 'bye', '  '])
+
+
+class ProcessFileTest(absltest.TestCase):
+  """Tests for process_file with a shared executor and per-thread sessions."""
+
+  def setUp(self):
+    super(ProcessFileTest, self).setUp()
+    self._dir = os.path.join(absltest.get_default_test_tmpdir(),
+                             self._testMethodName)
+    if not os.path.exists(self._dir):
+      os.makedirs(self._dir)
+    self._created = []
+    self._orig_create = back_translate.create_translator
+    back_translate.create_translator = self._create_translator
+
+  def tearDown(self):
+    back_translate.close_translators()
+    back_translate.create_translator = self._orig_create
+    super(ProcessFileTest, self).tearDown()
+
+  def _create_translator(self):
+    translator = _StubTranslator()
+    translator.client = _StubClient()
+    self._created.append(translator)
+    return translator
+
+  def _write_input(self, name, utterances):
+    path = os.path.join(self._dir, name)
+    with open(path, 'w') as f:
+      json.dump([{'turns': [{'utterance': u} for u in utterances]}], f)
+    return path
+
+  def test_sessions_shared_across_files(self):
+    executor = ThreadPoolExecutor(max_workers=2)
+    for name in ('a.json', 'b.json', 'c.json'):
+      path = self._write_input(name, ['hi %d' % i for i in range(6)] + ['hi 0'])
+      output = path + '.out'
+      back_translate.process_file(path, output, None, executor, batch_size=2)
+      with open(output) as f:
+        turns = json.load(f)[0]['turns']
+      self.assertEqual(turns[0]['utterance_noisy'], 'en:zh-cn:hi 0')
+      self.assertEqual(turns[6]['utterance_noisy'], 'en:zh-cn:hi 0')
+    executor.shutdown(wait=True)
+
+    # At most one session per worker thread, not one per file.
+    self.assertBetween(len(self._created), 1, 2)
+    back_translate.close_translators()
+    self.assertTrue(all(t.client.closed for t in self._created))
+
+
+if __name__ == "__main__":
+  absltest.main()
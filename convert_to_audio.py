@@ -1,12 +1,15 @@
 import os
-import json
+import orjson
 import logging
 import torch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
 from TTS.api import TTS
 from tenacity import retry, stop_after_attempt, wait_exponential
-import hashlib
+import xxhash
+import shutil
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -15,9 +18,13 @@ INPUT_FOLDER = "dev"
 OUTPUT_FOLDER = "audio_dev._coqui"
 # 配置参数
 BATCH_SIZE = 32  # 根据你的内存大小调整
-SAVE_INTERVAL = max(BATCH_SIZE // 10, 1)  # 保存频率随batch size调整
+SAVE_INTERVAL = max(BATCH_SIZE // 10, 1)  # 进度日志每写入多少条执行一次fsync
+WRITE_WORKERS = 4  # 后台写wav文件的线程数
+MAX_PENDING_WRITES = 32  # 最多允许多少个尚未完成的写盘任务
 
-PROGRESS_FILE = 'tts_progress.json'
+PROGRESS_FILE = 'tts_progress.log'  # 追加写入的进度日志，每行一个已处理的文件名
+LEGACY_PROGRESS_FILE = 'tts_progress.json'  # 旧版本保存的JSON进度，加载时一并读取
+SEEN_FILE = 'tts_seen.log'  # 追加写入的 utterance哈希 -> 音频文件名 日志，每行 "哈希\t文件名"，跨文件复用
 MAX_SAMPLES = 127  # 新增：限制处理的样本数量
 
 # 创建输出文件夹
@@ -36,6 +43,8 @@ logging.getLogger("numba").setLevel(logging.WARNING)
 
 # 全局TTS模型
 tts = None
+# 后台写盘线程池，使磁盘I/O与下一次GPU合成重叠
+_io_pool = ThreadPoolExecutor(max_workers=WRITE_WORKERS)
 
 def init_tts():
     """初始化TTS模型"""
@@ -54,6 +63,12 @@ def init_tts():
         
         print("正在初始化TTS模型，首次使用需要下载模型文件...")
         tts = download_and_init_tts()
+        if device == "cuda":
+            # Tacotron2 与 HiFiGAN 声码器使用FP16推理，并开启cuDNN自动调优
+            tts.synthesizer.tts_model.half()
+            if tts.synthesizer.vocoder_model is not None:
+                tts.synthesizer.vocoder_model.half()
+            torch.backends.cudnn.benchmark = True
         logging.info(f"TTS model initialized on {device}")
         
     except Exception as e:
@@ -63,15 +78,24 @@ def init_tts():
         raise
 
 
+def get_utterance_hash(utterance):
+    """计算utterance文本的哈希"""
+    return xxhash.xxh3_64_hexdigest(utterance.encode('utf-8'))
+
 def get_filename(dialogue_id, turn_index, speaker, utterance):
     """生成唯一的文件名"""
-    hash_object = hashlib.md5(utterance.encode('utf-8'))
-    hash_hex = hash_object.hexdigest()
+    hash_hex = get_utterance_hash(utterance)
     return f"dialogue_{dialogue_id}_turn_{turn_index}_{speaker}_{hash_hex[:8]}.wav"
 
+def synthesize(utterance):
+    """在inference_mode下合成波形，GPU上通过autocast让FP32输入与FP16权重匹配"""
+    with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=torch.float16,
+                                                enabled=torch.cuda.is_available()):
+        return tts.tts(text=utterance)
+
 @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def process_utterance(args):
-    """处理单个utterance并保存为音频文件"""
+def process_utterance(args, existing):
+    """合成单个utterance，并提交到后台线程写盘，返回写盘任务；文件已存在时返回 None"""
     global tts
     dialogue_id, turn_index, speaker, utterance = args
     if not utterance:
@@ -80,22 +104,66 @@ def process_utterance(args):
     filename = get_filename(dialogue_id, turn_index, speaker, utterance)
     output_path = os.path.join(OUTPUT_FOLDER, filename)
 
-    if os.path.exists(output_path):
-        return filename
+    # existing 为启动时的目录列表（随写盘更新），避免每个utterance一次 stat 系统调用
+    if filename in existing:
+        return
 
     try:
         if tts is None:
             init_tts()
-        tts.tts_to_file(
-            text=utterance,
-            file_path=output_path,
-            gpu=torch.cuda.is_available()  # 确保这里也使用 gpu 参数
-        )
-        return filename
+        wav = synthesize(utterance)
+        future = _io_pool.submit(write_wav, output_path, wav)
+        existing.add(filename)
+        return future
     except Exception as e:
         logging.error(f"Error converting text to speech for file {filename}: {e}")
         raise
 
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
+def write_wav(output_path, wav):
+    """将波形写入wav文件，失败时重试，重试耗尽后抛出异常由调用方处理
+
+    与 tts_to_file 一样经由 Synthesizer.save_wav 写盘，保持相同的峰值归一化和int16格式
+    """
+    tts.synthesizer.save_wav(wav=wav, path=output_path)
+
+def wait_for_write(pending_writes, existing, seen, seen_log, failed):
+    """等待最早的写盘任务完成并记录到 seen 日志；写盘失败时撤销 existing/seen 中的记录，并把该utterance加入 failed"""
+    future, utterance, filename, utterance_hash = pending_writes.popleft()
+    try:
+        future.result()
+    except Exception as e:
+        logging.error(f"Error writing audio file {filename}: {e}")
+        existing.discard(filename)
+        if seen.get(utterance_hash) == filename:
+            del seen[utterance_hash]
+        failed.add(utterance)
+        return
+    save_seen(seen_log, utterance_hash, filename)
+
+def link_duplicates(duplicates, existing, failed):
+    """为重复的utterance创建指向已合成音频的硬链接，不支持硬链接时复制文件；失败的utterance加入 failed"""
+    for utterance, source_name, filename in duplicates:
+        source_path = os.path.join(OUTPUT_FOLDER, source_name)
+        output_path = os.path.join(OUTPUT_FOLDER, filename)
+        if source_name not in existing:
+            # 源文件写入失败
+            logging.error(f"Source audio file {source_path} missing for {filename}")
+            failed.add(utterance)
+            continue
+        try:
+            os.link(source_path, output_path)
+        except FileExistsError:
+            pass
+        except OSError:
+            try:
+                shutil.copyfile(source_path, output_path)
+            except OSError as e:
+                logging.error(f"Error copying {source_path} to {filename}: {e}")
+                failed.add(utterance)
+                continue
+        existing.add(filename)
+
 def validate_utterance(utterance):
     """验证utterance是否有效"""
     if not isinstance(utterance, str):
@@ -113,10 +181,10 @@ def process_json_file(json_path, dialogues_processed=0):
         return [], dialogues_processed
         
     try:
-        with open(json_path, 'r', encoding='utf-8') as f:
+        with open(json_path, 'rb') as f:
             try:
-                data = json.load(f)
-            except json.JSONDecodeError as e:
+                data = orjson.loads(f.read())
+            except orjson.JSONDecodeError as e:
                 logging.error(f"Error decoding JSON from file {json_path}: {e}")
                 return [], dialogues_processed
     except IOError as e:
@@ -146,18 +214,53 @@ def process_json_file(json_path, dialogues_processed=0):
                 
     return utterances, dialogues_processed
 
-def save_progress(processed_files):
-    """保存处理进度"""
-    with open(PROGRESS_FILE, 'w') as f:
-        json.dump(list(processed_files), f)
+# 进度日志已写入的条数，用于控制fsync频率
+_progress_writes = 0
+
+def save_progress(progress_log, filename):
+    """向进度日志追加一个已处理的文件名"""
+    global _progress_writes
+    progress_log.write(filename + "\n")
+    progress_log.flush()
+    _progress_writes += 1
+    if _progress_writes % SAVE_INTERVAL == 0:
+        os.fsync(progress_log.fileno())
 
 def load_progress():
-    """加载处理进度"""
+    """加载处理进度，兼容旧版本的JSON进度文件"""
+    processed_files = set()
     try:
-        with open(PROGRESS_FILE, 'r') as f:
-            return set(json.load(f))
+        with open(LEGACY_PROGRESS_FILE, 'rb') as f:
+            processed_files.update(orjson.loads(f.read()))
     except FileNotFoundError:
-        return set()
+        pass
+    try:
+        with open(PROGRESS_FILE, 'r', encoding='utf-8') as f:
+            processed_files.update(line.strip() for line in f if line.strip())
+    except FileNotFoundError:
+        pass
+    return processed_files
+
+def save_seen(seen_log, utterance_hash, filename):
+    """向 seen 日志追加一条 哈希 -> 音频文件名 记录
+
+    加载时会与输出目录核对，崩溃丢失的末尾记录只会导致重新合成，因此不做fsync
+    """
+    seen_log.write(f"{utterance_hash}\t{filename}\n")
+    seen_log.flush()
+
+def load_seen():
+    """加载已合成utterance的哈希表，同一哈希以最后一条记录为准"""
+    seen = {}
+    try:
+        with open(SEEN_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                utterance_hash, sep, filename = line.rstrip('\n').partition('\t')
+                if sep and filename:
+                    seen[utterance_hash] = filename
+    except FileNotFoundError:
+        pass
+    return seen
 
 # def process_batch(utterances):
 #     """处理一批utterances"""
@@ -177,31 +280,66 @@ def load_progress():
 #         raise
 
 # 3. 优化进程数
-def process_batch(utterances):
-    global processed_files
+def process_batch(utterances, seen, existing, seen_log):
+    """处理一批utterances，返回合成、写盘或链接失败的utterance集合"""
     num_workers = min(4, max(cpu_count() - 1, 1))
+    failed = set()
     
     try:
-        # 使用单进程处理，因为TTS模型已经是全局的
-        for i, utterance in enumerate(tqdm(utterances, desc="Converting to audio")):
+        # 使用单进程合成，因为TTS模型已经是全局的；写盘在后台线程中进行
+        pending_writes = deque()
+        duplicates = []
+        for utterance in tqdm(utterances, desc="Converting to audio"):
             try:
-                process_utterance(utterance)
-                if (i + 1) % SAVE_INTERVAL == 0:
-                    save_progress(processed_files)
+                # 相同文本只合成一次，其余轮次在写盘完成后链接到已合成的音频
+                utterance_hash = get_utterance_hash(utterance[3])
+                filename = get_filename(*utterance)
+                source_name = seen.get(utterance_hash)
+                # seen 可能来自之前的运行，只有源音频确实在输出目录中时才按重复处理
+                if source_name and source_name != filename and source_name in existing:
+                    if filename not in existing:
+                        duplicates.append((utterance, source_name, filename))
+                else:
+                    future = process_utterance(utterance, existing)
+                    if future:
+                        pending_writes.append((future, utterance, filename, utterance_hash))
+                    elif source_name != filename:
+                        # 音频已在输出目录中，补记到 seen 日志
+                        save_seen(seen_log, utterance_hash, filename)
+                    seen[utterance_hash] = filename
+                # 限制未完成的写盘任务数量，避免波形在内存中堆积
+                while len(pending_writes) > MAX_PENDING_WRITES:
+                    wait_for_write(pending_writes, existing, seen, seen_log, failed)
             except Exception as e:
                 logging.error(f"处理utterance时出错: {e}")
+                failed.add(utterance)
                 continue
+        
+        # 批次结束时等待所有写盘完成，再链接重复的utterance
+        while pending_writes:
+            wait_for_write(pending_writes, existing, seen, seen_log, failed)
+        link_duplicates(duplicates, existing, failed)
                 
     except Exception as e:
         logging.error(f"批处理过程中发生错误: {e}")
         raise
+    return failed
+
+def record_processed(progress_log, processed_files, batch_files, failed):
+    """记录所有utterance都已输出音频的文件；含失败utterance的文件不记录，下次运行时重新处理"""
+    for json_file, utterances in batch_files:
+        if failed.intersection(utterances):
+            logging.error(f"File {json_file} has failed utterances, it will be processed again")
+            continue
+        processed_files.add(json_file)
+        save_progress(progress_log, json_file)
 
 
 def cleanup():
     """清理临时文件和资源"""
     try:
-        # 可以添加清理临时文件的代码
-        pass
+        # 等待后台写盘任务完成
+        _io_pool.shutdown(wait=True)
     except Exception as e:
         logging.error(f"清理过程中发生错误: {e}")
 
@@ -209,6 +347,9 @@ def main():
     """主函数"""
     try:
         processed_files = load_progress()
+        seen = load_seen()
+        # 输出目录只列举一次，之后随写盘结果更新
+        existing = set(os.listdir(OUTPUT_FOLDER))
         
         json_files = [f for f in os.listdir(INPUT_FOLDER) 
                      if f.endswith('.json') and f not in processed_files]
@@ -223,9 +364,12 @@ def main():
         init_tts()
 
         all_utterances = []
+        batch_files = []  # 本批次包含的文件及其utterances，批次成功后才记录进度
         dialogues_processed = 0  # 改名以更清晰地表示是对话数量
         
-        with tqdm(total=len(json_files), desc="收集utterances", unit="file") as pbar:
+        with open(PROGRESS_FILE, 'a', encoding='utf-8') as progress_log, \
+                open(SEEN_FILE, 'a', encoding='utf-8') as seen_log, \
+                tqdm(total=len(json_files), desc="收集utterances", unit="file") as pbar:
             for json_file in json_files:
                 if dialogues_processed >= MAX_SAMPLES:
                     break
@@ -233,17 +377,19 @@ def main():
                 json_path = os.path.join(INPUT_FOLDER, json_file)
                 utterances, dialogues_processed = process_json_file(json_path, dialogues_processed)
                 all_utterances.extend(utterances)
+                batch_files.append((json_file, utterances))
                 
                 if len(all_utterances) >= BATCH_SIZE:
-                    process_batch(all_utterances)
+                    failed = process_batch(all_utterances, seen, existing, seen_log)
+                    record_processed(progress_log, processed_files, batch_files, failed)
                     all_utterances = []
+                    batch_files = []
                 
-                processed_files.add(json_file)
-                save_progress(processed_files)
                 pbar.update(1)
             
-            if all_utterances:
-                process_batch(all_utterances)
+            if batch_files:
+                failed = process_batch(all_utterances, seen, existing, seen_log)
+                record_processed(progress_log, processed_files, batch_files, failed)
 
         print(f"处理完成 {dialogues_processed} 个对话。")
         print(f"音频文件保存在 '{OUTPUT_FOLDER}' 文件夹中。")
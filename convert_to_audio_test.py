@@ -0,0 +1,250 @@
+# coding=utf-8
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for convert_to_audio.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import deque
+from concurrent.futures import Future
+import io
+import os
+import shutil
+
+from absl.testing import absltest
+
+from schema_guided_dst import convert_to_audio
+
+
+class _StubSynthesizer(object):
+  """Synthesizer stub that writes the utterance text as the wav content."""
+
+  def __init__(self, fail=()):
+    self._fail = set(fail)
+
+  def save_wav(self, wav, path):
+    if wav in self._fail:
+      raise IOError('disk full')
+    with open(path, 'w') as f:
+      f.write(wav)
+
+
+class _StubTTS(object):
+  """TTS stub whose waveform is the input text itself."""
+
+  def __init__(self, fail=()):
+    self.calls = []
+    self.synthesizer = _StubSynthesizer(fail)
+
+  def tts(self, text):
+    self.calls.append(text)
+    return text
+
+
+def _done(exception=None):
+  future = Future()
+  if exception:
+    future.set_exception(exception)
+  else:
+    future.set_result(None)
+  return future
+
+
+class _ConvertToAudioTestCase(absltest.TestCase):
+  """Points the module's files at a fresh temporary directory."""
+
+  _PATCHED = ('OUTPUT_FOLDER', 'PROGRESS_FILE', 'LEGACY_PROGRESS_FILE',
+              'SEEN_FILE', 'tts', 'write_wav')
+
+  def setUp(self):
+    super(_ConvertToAudioTestCase, self).setUp()
+    self._dir = os.path.join(absltest.get_default_test_tmpdir(),
+                             type(self).__name__, self._testMethodName)
+    shutil.rmtree(self._dir, ignore_errors=True)
+    self._output = os.path.join(self._dir, 'audio')
+    os.makedirs(self._output)
+    self._orig = {name: getattr(convert_to_audio, name)
+                  for name in self._PATCHED}
+    convert_to_audio.OUTPUT_FOLDER = self._output
+    convert_to_audio.PROGRESS_FILE = os.path.join(self._dir, 'progress.log')
+    convert_to_audio.LEGACY_PROGRESS_FILE = os.path.join(self._dir,
+                                                         'progress.json')
+    convert_to_audio.SEEN_FILE = os.path.join(self._dir, 'seen.log')
+    self.tts = _StubTTS()
+    convert_to_audio.tts = self.tts
+    # Skip the retry back-off so write failures surface immediately.
+    convert_to_audio.write_wav = self._orig['write_wav'].__wrapped__
+
+  def tearDown(self):
+    for name, value in self._orig.items():
+      setattr(convert_to_audio, name, value)
+    super(_ConvertToAudioTestCase, self).tearDown()
+
+  def write_output(self, filename, content='old'):
+    with open(os.path.join(self._output, filename), 'w') as f:
+      f.write(content)
+
+  def read_output(self, filename):
+    with open(os.path.join(self._output, filename)) as f:
+      return f.read()
+
+
+class ProgressTest(_ConvertToAudioTestCase):
+  """Tests for save_progress and load_progress."""
+
+  def test_missing_files(self):
+    self.assertEqual(convert_to_audio.load_progress(), set())
+
+  def test_merges_legacy_json(self):
+    with open(convert_to_audio.LEGACY_PROGRESS_FILE, 'w') as f:
+      f.write('["a.json", "b.json"]')
+    with open(convert_to_audio.PROGRESS_FILE, 'w') as f:
+      convert_to_audio.save_progress(f, 'b.json')
+      convert_to_audio.save_progress(f, 'c.json')
+    self.assertEqual(convert_to_audio.load_progress(),
+                     {'a.json', 'b.json', 'c.json'})
+
+
+class SeenTest(_ConvertToAudioTestCase):
+  """Tests for save_seen and load_seen."""
+
+  def test_missing_file(self):
+    self.assertEqual(convert_to_audio.load_seen(), {})
+
+  def test_last_entry_wins(self):
+    with open(convert_to_audio.SEEN_FILE, 'w') as f:
+      convert_to_audio.save_seen(f, 'h1', 'a.wav')
+      convert_to_audio.save_seen(f, 'h2', 'b.wav')
+      convert_to_audio.save_seen(f, 'h1', 'c.wav')
+      # A line cut short by a crash is ignored.
+      f.write('h3')
+    self.assertEqual(convert_to_audio.load_seen(),
+                     {'h1': 'c.wav', 'h2': 'b.wav'})
+
+
+class WaitForWriteTest(_ConvertToAudioTestCase):
+  """Tests for wait_for_write."""
+
+  def test_success_is_logged(self):
+    seen_log = io.StringIO()
+    existing, seen, failed = {'a.wav'}, {'h': 'a.wav'}, set()
+    pending = deque([(_done(), 'utt', 'a.wav', 'h')])
+    convert_to_audio.wait_for_write(pending, existing, seen, seen_log, failed)
+    self.assertEmpty(pending)
+    self.assertEqual(seen_log.getvalue(), 'h\ta.wav\n')
+    self.assertEqual(failed, set())
+
+  def test_failure_is_rolled_back(self):
+    seen_log = io.StringIO()
+    existing, seen, failed = {'a.wav'}, {'h': 'a.wav'}, set()
+    pending = deque([(_done(IOError('disk full')), 'utt', 'a.wav', 'h')])
+    convert_to_audio.wait_for_write(pending, existing, seen, seen_log, failed)
+    self.assertEqual(existing, set())
+    self.assertEqual(seen, {})
+    self.assertEqual(seen_log.getvalue(), '')
+    self.assertEqual(failed, {'utt'})
+
+
+class LinkDuplicatesTest(_ConvertToAudioTestCase):
+  """Tests for link_duplicates."""
+
+  def test_links_to_source(self):
+    self.write_output('a.wav', 'audio')
+    existing, failed = {'a.wav'}, set()
+    convert_to_audio.link_duplicates([('utt', 'a.wav', 'b.wav')], existing,
+                                     failed)
+    self.assertEqual(self.read_output('b.wav'), 'audio')
+    self.assertEqual(existing, {'a.wav', 'b.wav'})
+    self.assertEqual(failed, set())
+
+  def test_missing_source_fails(self):
+    existing, failed = set(), set()
+    convert_to_audio.link_duplicates([('utt', 'a.wav', 'b.wav')], existing,
+                                     failed)
+    self.assertFalse(os.path.exists(os.path.join(self._output, 'b.wav')))
+    self.assertEqual(existing, set())
+    self.assertEqual(failed, {'utt'})
+
+
+class ProcessBatchTest(_ConvertToAudioTestCase):
+  """Tests for process_batch and record_processed."""
+
+  def test_duplicates_synthesized_once(self):
+    utterances = [('d1', 0, 'USER', 'hello'), ('d1', 1, 'SYSTEM', 'hi'),
+                  ('d2', 0, 'USER', 'hello')]
+    seen, existing, seen_log = {}, set(), io.StringIO()
+    failed = convert_to_audio.process_batch(utterances, seen, existing,
+                                            seen_log)
+    self.assertEqual(failed, set())
+    self.assertEqual(self.tts.calls, ['hello', 'hi'])
+    filenames = [convert_to_audio.get_filename(*u) for u in utterances]
+    self.assertEqual(existing, set(filenames))
+    self.assertEqual(self.read_output(filenames[2]), 'hello')
+    self.assertEqual(seen_log.getvalue().count('\n'), 2)
+
+  def test_seen_from_previous_run(self):
+    source = ('d1', 0, 'USER', 'hello')
+    repeat = ('d2', 0, 'USER', 'hello')
+    source_name = convert_to_audio.get_filename(*source)
+    seen = {convert_to_audio.get_utterance_hash('hello'): source_name}
+
+    # The source wav is gone, so the repeat is synthesized instead of linked.
+    existing = set()
+    failed = convert_to_audio.process_batch([repeat], seen, existing,
+                                            io.StringIO())
+    self.assertEqual(failed, set())
+    self.assertEqual(self.tts.calls, ['hello'])
+    self.assertIn(convert_to_audio.get_filename(*repeat), existing)
+
+    # With the source on disk the repeat is linked.
+    self.write_output(source_name)
+    seen = {convert_to_audio.get_utterance_hash('hello'): source_name}
+    existing = {source_name}
+    self.tts.calls = []
+    repeat = ('d3', 0, 'USER', 'hello')
+    failed = convert_to_audio.process_batch([repeat], seen, existing,
+                                            io.StringIO())
+    self.assertEqual(failed, set())
+    self.assertEqual(self.tts.calls, [])
+    self.assertEqual(
+        self.read_output(convert_to_audio.get_filename(*repeat)), 'old')
+
+  def test_write_failure_fails_duplicates(self):
+    self.tts.synthesizer = _StubSynthesizer(fail=['hello'])
+    utterances = [('d1', 0, 'USER', 'hello'), ('d1', 1, 'SYSTEM', 'hi'),
+                  ('d2', 0, 'USER', 'hello')]
+    seen, existing = {}, set()
+    failed = convert_to_audio.process_batch(utterances, seen, existing,
+                                            io.StringIO())
+    self.assertEqual(failed, {utterances[0], utterances[2]})
+    self.assertEqual(existing, {convert_to_audio.get_filename(*utterances[1])})
+    self.assertNotIn(convert_to_audio.get_utterance_hash('hello'), seen)
+
+  def test_record_processed_skips_failed_files(self):
+    batch_files = [('a.json', [('d1', 0, 'USER', 'hello')]),
+                   ('b.json', [('d2', 0, 'USER', 'hi')]),
+                   ('c.json', [])]
+    processed_files = set()
+    with open(convert_to_audio.PROGRESS_FILE, 'w') as f:
+      convert_to_audio.record_processed(f, processed_files, batch_files,
+                                        {('d1', 0, 'USER', 'hello')})
+    self.assertEqual(processed_files, {'b.json', 'c.json'})
+    self.assertEqual(convert_to_audio.load_progress(), {'b.json', 'c.json'})
+
+
+if __name__ == "__main__":
+  absltest.main()